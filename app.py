@@ -1,78 +1,245 @@
-from flask import Flask, request, jsonify
-from flask_cors import CORS
-from satellite_core import process_satellite_data
+from flask import Flask, request, jsonify, Response
+from flask.json.provider import DefaultJSONProvider
+from satellite_core import process_satellite_data, AnalysisCancelled
 import geopy.geocoders
 from geopy.geocoders import Nominatim
-import time
-import os
+import re
+import uuid
+import threading
+import queue
+from cachetools import TTLCache
+from concurrent.futures import ThreadPoolExecutor
+import diskcache
+import orjson
+
+class OrjsonProvider(DefaultJSONProvider):
+    # Encodes with orjson, keeping the default provider's sorted keys and its
+    # fallback for types orjson doesn't handle; indent/separators are ignored
+    def dumps(self, obj, **kwargs):
+        option = orjson.OPT_NON_STR_KEYS
+        if kwargs.get('sort_keys', self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=self.default, option=option).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
 app = Flask(__name__)
-CORS(app, resources={r"/map/*": {"origins": "*"}})  # Enable CORS for map endpoint
+app.json = OrjsonProvider(app)
+
+# CORS is only needed for the map endpoint, so send static headers rather than
+# matching every request against flask_cors resource patterns
+MAP_CORS_HEADERS = {'Access-Control-Allow-Origin': '*'}
+MAP_PREFLIGHT_HEADERS = {
+    'Access-Control-Allow-Methods': 'GET, OPTIONS',
+    'Access-Control-Allow-Headers': '*',
+    'Access-Control-Max-Age': '86400'
+}
+
+@app.before_request
+def handle_map_preflight():
+    if request.method == 'OPTIONS' and request.path.startswith('/map/'):
+        return '', 204, MAP_PREFLIGHT_HEADERS
+
+@app.after_request
+def add_map_cors_headers(response):
+    if request.path.startswith('/map/'):
+        response.headers.update(MAP_CORS_HEADERS)
+    return response
 
 # Geocoder setup
 geolocator = Nominatim(user_agent="satellite_app")
 
-# Simulate progress tracking
-progress = {}
+# Geocoding cache: in-process TTLCache backed by a disk cache that survives
+# restarts. Only found cities are cached, so a miss is retried next time.
+GEOCODE_TTL = 30 * 24 * 3600  # cities rarely move
+geocode_memory = TTLCache(maxsize=4096, ttl=GEOCODE_TTL)
+geocode_memory_lock = threading.Lock()
+geocode_cache = diskcache.Cache('/tmp/geocache')
 
-@app.route('/analyze', methods=['POST'])
-def analyze_city():
-    data = request.get_json()
-    city_name = data.get('city')
-    radius_km = data.get('radius', 10)
-    request_id = str(time.time())
-    progress[request_id] = 0
-    
+def geocode_city(name):
+    # name is expected to be lowercased and stripped; returns (lat, lon) or None
+    with geocode_memory_lock:
+        center = geocode_memory.get(name)
+    if center is not None:
+        return center
+    center = geocode_cache.get(name)
+    if center is None:
+        location = geolocator.geocode(name)
+        if not location and name == 'delhi':
+            location = geolocator.geocode('New Delhi')
+        if not location:
+            return None
+        center = (location.latitude, location.longitude)
+        geocode_cache.set(name, center, expire=GEOCODE_TTL)
+    with geocode_memory_lock:
+        geocode_memory[name] = center
+    return center
+
+# Progress tracking, bounded so finished requests don't accumulate forever.
+# progress maps request_id -> ProgressSlot; the lock only guards the cache itself.
+MAX_PROGRESS_ENTRIES = 10000
+PROGRESS_TTL = 600
+SSE_KEEPALIVE_SECONDS = 15
+progress = TTLCache(maxsize=MAX_PROGRESS_ENTRIES, ttl=PROGRESS_TTL)
+progress_lock = threading.Lock()
+
+# Analyses run in the background so /analyze returns immediately
+analysis_executor = ThreadPoolExecutor(max_workers=16)
+
+class ProgressSlot:
+    # Writers hold the slot directly, so an update is a plain attribute write
+    # (atomic under the GIL) plus a queue put, with no lock or cache lookup.
+    # event is the latest progress event; events feeds the SSE stream until
+    # the final event has been streamed. Only one live stream may read events
+    # at a time (stream_claim); cancelled is set when that stream's client
+    # goes away, so the analysis can stop early.
+    __slots__ = ('event', 'events', 'cancelled', 'stream_claim')
+
+    def __init__(self):
+        self.event = {'progress': 0}
+        self.events = queue.Queue()
+        self.cancelled = threading.Event()
+        self.stream_claim = threading.Lock()
+
+    def set(self, value, **extra):
+        event = dict(extra, progress=value)
+        self.event = event
+        events = self.events
+        if events is not None:
+            events.put(event)
+
+def start_progress(request_id):
+    slot = ProgressSlot()
+    with progress_lock:
+        progress[request_id] = slot
+    return slot
+
+def get_progress_slot(request_id):
+    with progress_lock:
+        return progress.get(request_id)
+
+def run_analysis(slot, city_name, radius_km):
     try:
-        location = geolocator.geocode(city_name)
+        location = geocode_city(city_name.strip().lower())
         if not location:
-            if city_name.lower() == 'delhi':
-                location = geolocator.geocode('New Delhi')
-            if not location:
-                progress[request_id] = -1
-                return jsonify({'error': 'City not found', 'request_id': request_id}), 404
-        center = [location.latitude, location.longitude]
+            slot.set(-1, error='City not found')
+            return
+        center = list(location)
+        slot.set(10)
     except Exception as e:
-        progress[request_id] = -1
-        return jsonify({'error': f'Geocoding error: {str(e)}', 'request_id': request_id}), 500
+        slot.set(-1, error=f'Geocoding error: {str(e)}')
+        return
     
     try:
-        for i in range(10, 100, 10):
-            progress[request_id] = i
-            time.sleep(0.5)
-        map_data = process_satellite_data(center, radius_km)
-        progress[request_id] = 100
-        return jsonify({
-            'center': center,
-            'map_data': map_data,
-            'request_id': request_id
-        })
+        map_data = process_satellite_data(center, radius_km, slot.set, slot.cancelled)
+        slot.set(100, center=center, map_data=map_data)
+    except AnalysisCancelled:
+        slot.set(-1, error='Analysis cancelled')
     except Exception as e:
-        progress[request_id] = -1
-        return jsonify({'error': f'Satellite data error: {str(e)}', 'request_id': request_id}), 500
+        slot.set(-1, error=f'Satellite data error: {str(e)}')
+
+@app.route('/analyze', methods=['POST'])
+def analyze_city():
+    data = request.get_json(cache=True, silent=True)
+    if not isinstance(data, dict):
+        data = {}
+    city_name = data.get('city')
+    if not isinstance(city_name, str) or not city_name.strip():
+        return jsonify({'error': 'Missing city'}), 400
+    radius_km = data.get('radius', 10)
+    request_id = uuid.uuid4().hex
+    slot = start_progress(request_id)
+    analysis_executor.submit(run_analysis, slot, city_name, radius_km)
+    return jsonify({'request_id': request_id}), 202
 
 @app.route('/progress/<request_id>', methods=['GET'])
 def get_progress(request_id):
-    return jsonify({'progress': progress.get(request_id, 0)})
+    slot = get_progress_slot(request_id)
+    return jsonify(slot.event if slot is not None else {'progress': 0})
+
+@app.route('/progress-stream/<request_id>', methods=['GET'])
+def stream_progress(request_id):
+    slot = get_progress_slot(request_id)
+    if slot is None:
+        return jsonify({'error': 'Unknown request_id'}), 404
+
+    if slot.events is None:
+        # Stream already consumed; replay the final state once
+        return Response(f'data: {app.json.dumps(slot.event)}\n\n', mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache'})
+    if not slot.stream_claim.acquire(blocking=False):
+        return jsonify({'error': 'Progress stream already open'}), 409
+
+    def stream():
+        events = slot.events
+        try:
+            if events is None:
+                # A previous stream finished between the check and the claim
+                yield f'data: {app.json.dumps(slot.event)}\n\n'
+                return
+            while True:
+                try:
+                    event = events.get(timeout=SSE_KEEPALIVE_SECONDS)
+                except queue.Empty:
+                    if slot.event['progress'] in (100, -1):
+                        # Final event was already taken off the queue
+                        yield f'data: {app.json.dumps(slot.event)}\n\n'
+                        return
+                    yield ': keep-alive\n\n'
+                    continue
+                yield f'data: {app.json.dumps(event)}\n\n'
+                if event['progress'] in (100, -1):
+                    slot.events = None
+                    return
+        except GeneratorExit:
+            # Client disconnected before the analysis finished
+            slot.cancelled.set()
+            raise
+
+    response = Response(stream(), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    response.call_on_close(slot.stream_claim.release)
+    return response
+
+# map.html is static, so read it once and pre-split it around its
+# {{placeholders}}; rendering is then a single join with no scanning
+MAP_FILE = '/home/adityadm2110/mysite/static/map.html'  # Absolute path
+MAP_PLACEHOLDER_RE = re.compile(r'\{\{(centerLat|centerLon|city)\}\}')
+
+def load_map_template(path):
+    with open(path, 'r') as file:
+        # Even indices are literal text, odd indices are placeholder names
+        return MAP_PLACEHOLDER_RE.split(file.read())
+
+def render_map_template(segments, values):
+    parts = list(segments)
+    for i in range(1, len(parts), 2):
+        parts[i] = values[parts[i]]
+    return ''.join(parts)
+
+try:
+    MAP_TEMPLATE = load_map_template(MAP_FILE)
+    app.logger.info(f'Loaded map template: {MAP_FILE}')
+except FileNotFoundError:
+    MAP_TEMPLATE = None
+    app.logger.error(f'File not found: {MAP_FILE}')
 
 @app.route('/map/<city>/<float:lat>/<float:lon>')
 def serve_map(city, lat, lon):
     try:
-        map_file = '/home/adityadm2110/mysite/static/map.html'  # Absolute path
-        app.logger.info(f'Attempting to serve file: {map_file}')
-        if not os.path.exists(map_file):
-            app.logger.error(f'File not found: {map_file}')
+        if MAP_TEMPLATE is None:
             return jsonify({'error': 'map.html not found'}), 404
-        with open(map_file, 'r') as file:
-            html_content = file.read()
-        html_content = html_content.replace('{{centerLat}}', str(lat))
-        html_content = html_content.replace('{{centerLon}}', str(lon))
-        html_content = html_content.replace('{{city}}', city)
-        app.logger.info('Successfully read and processed map.html')
+        html_content = render_map_template(MAP_TEMPLATE, {
+            'centerLat': str(lat),
+            'centerLon': str(lon),
+            'city': city
+        })
         return html_content, 200, {'Content-Type': 'text/html'}
     except Exception as e:
         app.logger.error(f'Error serving map.html: {str(e)}')
         return jsonify({'error': f'Failed to serve map: {str(e)}'}), 500
 
 if __name__ == '__main__':
-    app.run(debug=True, port=5001)
\ No newline at end of file
+    # Dev fallback only; in production run under gunicorn (see gunicorn.conf.py)
+    app.run(threaded=True, debug=False, port=5001)
\ No newline at end of file
@@ -0,0 +1,10 @@
+# Production server config: gunicorn -c gunicorn.conf.py app:app
+#
+# Progress state and SSE queues live in process memory, so a request's
+# /progress-stream must be served by the worker that ran /analyze. Keep a
+# single worker and scale with threads; the work is network-bound on GEE
+# and Nominatim, so threads overlap well.
+bind = ':5001'
+workers = 1
+worker_class = 'gthread'
+threads = 32
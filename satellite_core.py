@@ -1,19 +1,94 @@
 import ee
 from datetime import datetime
 import logging
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import threading
+from cachetools import TTLCache
+import diskcache
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Initialize Google Earth Engine
-try:
-    ee.Initialize()
-    logger.info("GEE initialized successfully")
-except Exception as e:
-    logger.error(f"GEE initialization failed: {str(e)}")
-    ee.Authenticate()
-    ee.Initialize()
+# Google Earth Engine is initialized lazily on first use, not at import, so
+# forked workers don't all authenticate up front.
+_ee_lock = threading.Lock()
+_ee_ready = False
+
+# Analysis period, fixed for every request
+START_DATE = '2023-01-01'
+END_DATE = '2023-12-31'
+
+# Immutable server-side references shared by all requests. ee objects can only
+# be built after ee.Initialize(), so _ensure_ee() fills these in.
+_year_filter = None
+_srtm_terrain = None
+_surface_water = None
+
+def _build_ee_constants():
+    global _year_filter, _srtm_terrain, _surface_water
+    _year_filter = ee.Filter.date(START_DATE, END_DATE)
+    _srtm_terrain = ee.Terrain.products(ee.Image('USGS/SRTMGL1_003')).select(['elevation', 'slope', 'aspect'])
+    _surface_water = ee.Image('JRC/GSW1_4/GlobalSurfaceWater').select('occurrence')
+
+def _ensure_ee():
+    global _ee_ready
+    if _ee_ready:
+        return
+    with _ee_lock:
+        if _ee_ready:
+            return
+        try:
+            # Without a service account, keep ee's default stored credentials.
+            # The default endpoint is kept because the url argument would also
+            # move the map tile URLs off the cached tile servers.
+            kwargs = {}
+            service_account = os.environ.get('GEE_SERVICE_ACCOUNT')
+            key_file = os.environ.get('GEE_KEY_FILE')
+            if service_account and key_file:
+                kwargs['credentials'] = ee.ServiceAccountCredentials(service_account, key_file)
+            ee.Initialize(**kwargs)
+            _build_ee_constants()
+            _ee_ready = True
+            logger.info("GEE initialized successfully")
+        except Exception as e:
+            logger.error(f"GEE initialization failed: {str(e)}")
+            raise
+
+# getMapId visualization parameters for each map layer
+_VIS_PARAMS = {
+    'NDVI': {'min': -0.2, 'max': 0.8, 'palette': ['blue', 'yellow', 'green']},
+    'EVI': {'min': -0.2, 'max': 0.8, 'palette': ['blue', 'yellow', 'green']},
+    'NDWI': {'min': -0.2, 'max': 0.8, 'palette': ['red', 'yellow', 'blue']},
+    'NDBI': {'min': -0.2, 'max': 0.8, 'palette': ['red', 'yellow', 'blue']},
+    'LST': {'min': 290, 'max': 310, 'palette': ['red', 'yellow', 'blue']},
+}
+_ALBEDO_VIS = {'min': 0, 'max': 0.3, 'palette': ['black', 'white']}
+_ELEVATION_VIS = {'min': 0, 'max': 1000, 'palette': ['green', 'brown']}
+_WATER_VIS = {'min': 0, 'max': 100, 'palette': ['white', 'blue']}
+_NO2_VIS = {'min': 0, 'max': 0.0001, 'palette': ['green', 'yellow', 'red']}
+
+# Tile URLs are deterministic for a fixed ROI and date range, so cache them
+MAP_CACHE_TTL = 3600
+_map_cache = TTLCache(maxsize=1024, ttl=MAP_CACHE_TTL)
+_map_cache_lock = threading.Lock()
+_map_disk_cache = diskcache.Cache('/tmp/mapcache')
+
+def get_cached_map_data(key):
+    with _map_cache_lock:
+        map_data = _map_cache.get(key)
+    if map_data is None:
+        map_data = _map_disk_cache.get(key)
+        if map_data is not None:
+            with _map_cache_lock:
+                _map_cache[key] = map_data
+    return dict(map_data) if map_data is not None else None
+
+def set_cached_map_data(key, map_data):
+    with _map_cache_lock:
+        _map_cache[key] = dict(map_data)
+    _map_disk_cache.set(key, dict(map_data), expire=MAP_CACHE_TTL)
 
 def calculate_ndvi(image):
     try:
@@ -50,18 +125,47 @@ def calculate_ndbi(image):
         logger.error(f"NDBI calculation error: {str(e)}")
         raise
 
-def get_landsat_data(roi, start_date, end_date):
+def make_bounds_date_filter(roi):
+    # Built once per request and shared by every collection
+    return ee.Filter.And(ee.Filter.bounds(roi), _year_filter)
+
+def landsat_collection(bounds_date_filter):
+    return ee.ImageCollection('LANDSAT/LC08/C02/T1_L2') \
+        .filter(bounds_date_filter) \
+        .filter(ee.Filter.lt('CLOUD_COVER', 20))
+
+def modis_collection(bounds_date_filter):
+    return ee.ImageCollection('MODIS/006/MCD43A3') \
+        .filter(bounds_date_filter) \
+        .select('Albedo_BSA_Band1')
+
+def sentinel5p_collection(bounds_date_filter, pollutant='NO2'):
+    return ee.ImageCollection('COPERNICUS/S5P/OFFL/L3_' + pollutant) \
+        .filter(bounds_date_filter) \
+        .select('tropospheric_NO2_column_number_density')
+
+def check_image_counts(bounds_date_filter, pollutant='NO2'):
+    # One getInfo round-trip for all three emptiness checks
     try:
-        landsat = ee.ImageCollection('LANDSAT/LC08/C02/T1_L2') \
-            .filterBounds(roi) \
-            .filterDate(start_date, end_date) \
-            .filter(ee.Filter.lt('CLOUD_COVER', 20))
-        
-        count = landsat.size().getInfo()
-        if count == 0:
-            raise Exception("No Landsat images found for the given region and time")
-        
-        landsat = landsat.median()
+        counts = ee.Dictionary({
+            'landsat': landsat_collection(bounds_date_filter).size(),
+            'modis': modis_collection(bounds_date_filter).size(),
+            's5p': sentinel5p_collection(bounds_date_filter, pollutant).size(),
+        }).getInfo()
+    except Exception as e:
+        logger.error(f"Image count check error: {str(e)}")
+        raise
+    if counts['landsat'] == 0:
+        raise Exception("No Landsat images found for the given region and time")
+    if counts['modis'] == 0:
+        raise Exception("No MODIS albedo images found")
+    if counts['s5p'] == 0:
+        raise Exception(f"No Sentinel-5P {pollutant} images found")
+    return counts
+
+def get_landsat_data(bounds_date_filter):
+    try:
+        landsat = landsat_collection(bounds_date_filter).median()
         landsat = landsat.select(['SR_B2', 'SR_B3', 'SR_B4', 'SR_B5', 'SR_B6', 'ST_B10'])
         
         scale_factor = 0.0000275
@@ -83,94 +187,113 @@ def get_landsat_data(roi, start_date, end_date):
         logger.error(f"Landsat error: {str(e)}")
         raise
 
-def get_modis_albedo(roi, start_date, end_date):
+def get_modis_albedo(bounds_date_filter):
     try:
-        modis = ee.ImageCollection('MODIS/006/MCD43A3') \
-            .filterBounds(roi) \
-            .filterDate(start_date, end_date) \
-            .select('Albedo_BSA_Band1')
-        
-        count = modis.size().getInfo()
-        if count == 0:
-            raise Exception("No MODIS albedo images found")
-        
-        modis = modis.median()
+        modis = modis_collection(bounds_date_filter).median()
         logger.info("MODIS albedo processed successfully")
         return modis
     except Exception as e:
         logger.error(f"MODIS error: {str(e)}")
         raise
 
-def get_sentinel5p_air_quality(roi, start_date, end_date, pollutant='NO2'):
+def get_sentinel5p_air_quality(bounds_date_filter, pollutant='NO2'):
     try:
-        dataset = ee.ImageCollection('COPERNICUS/S5P/OFFL/L3_' + pollutant) \
-            .filterBounds(roi) \
-            .filterDate(start_date, end_date) \
-            .select('tropospheric_NO2_column_number_density')
-        
-        count = dataset.size().getInfo()
-        if count == 0:
-            raise Exception(f"No Sentinel-5P {pollutant} images found")
-        
-        dataset = dataset.median()
+        dataset = sentinel5p_collection(bounds_date_filter, pollutant).median()
         logger.info(f"Sentinel-5P {pollutant} processed successfully")
         return dataset
     except Exception as e:
         logger.error(f"Sentinel-5P error: {str(e)}")
         raise
 
-def get_srtm_dem(roi):
-    try:
-        dem = ee.Terrain.products(ee.Image('USGS/SRTMGL1_003')).select(['elevation', 'slope', 'aspect'])
-        logger.info("SRTM DEM processed successfully")
-        return dem
-    except Exception as e:
-        logger.error(f"SRTM error: {str(e)}")
-        raise
+class AnalysisCancelled(Exception):
+    pass
 
-def get_surface_water(roi):
-    try:
-        water = ee.Image('JRC/GSW1_4/GlobalSurfaceWater').select('occurrence')
-        logger.info("Surface water processed successfully")
-        return water
-    except Exception as e:
-        logger.error(f"Surface water error: {str(e)}")
-        raise
+def check_cancelled(cancel_event):
+    if cancel_event is not None and cancel_event.is_set():
+        raise AnalysisCancelled("Analysis cancelled by client")
+
+def iter_completed(futures, cancel_event=None):
+    # Like as_completed, but raises AnalysisCancelled between completions.
+    # In-flight GEE HTTP calls can't be aborted; callers shut their pool down
+    # without waiting so those calls finish in the background and are discarded.
+    for future in as_completed(futures):
+        check_cancelled(cancel_event)
+        yield future
+
+def get_tile_url(image, vis_params, name, required=False):
+    map_id = image.getMapId(vis_params)
+    if 'tile_fetcher' not in map_id:
+        if required:
+            logger.error(f"Failed to get map ID for {name}")
+            raise Exception(f"Failed to get map ID for {name}")
+        return ''
+    return map_id['tile_fetcher'].url_format
+
+def process_satellite_data(center, radius_km, progress_callback=None, cancel_event=None):
+    def report(value):
+        if progress_callback:
+            progress_callback(value)
 
-def process_satellite_data(center, radius_km):
     try:
+        # Rounding to 3 decimals (~100 m) absorbs small geocoding jitter
+        cache_key = (round(center[0], 3), round(center[1], 3), radius_km, START_DATE, END_DATE)
+        map_data = get_cached_map_data(cache_key)
+        if map_data is not None:
+            logger.info("Map data served from cache")
+            return map_data
+        
+        check_cancelled(cancel_event)
+        _ensure_ee()
         roi = ee.Geometry.Point(center[1], center[0]).buffer(radius_km * 1000)
-        start_date = '2023-01-01'
-        end_date = '2023-12-31'
+        bounds_date_filter = make_bounds_date_filter(roi)
         
-        landsat = get_landsat_data(roi, start_date, end_date)
-        albedo = get_modis_albedo(roi, start_date, end_date)
-        dem = get_srtm_dem(roi)
-        water = get_surface_water(roi)
-        no2 = get_sentinel5p_air_quality(roi, start_date, end_date, 'NO2')
+        # The dataset builders only assemble a lazy ee graph locally; the network
+        # calls are the image count check and the getMapId requests below
+        landsat = get_landsat_data(bounds_date_filter)
+        albedo = get_modis_albedo(bounds_date_filter)
+        no2 = get_sentinel5p_air_quality(bounds_date_filter, 'NO2')
+        report(20)
         
+        # All Landsat layers select from the one shared composite. They stay as
+        # separate map IDs because the map page toggles them independently.
+        layers = {}
+        for band, vis_params in _VIS_PARAMS.items():
+            layers[band] = (landsat.select(band), vis_params, True)
+        layers['albedo'] = (albedo, _ALBEDO_VIS, False)
+        layers['elevation'] = (_srtm_terrain.select('elevation'), _ELEVATION_VIS, False)
+        layers['water'] = (_surface_water, _WATER_VIS, False)
+        layers['no2'] = (no2, _NO2_VIS, False)
+        
+        check_cancelled(cancel_event)
+        # The count check and the getMapId calls are independent HTTP requests
+        # to GEE, so run them all at once; an empty collection raises from the
+        # count check's future
         map_data = {}
-        for band in ['NDVI', 'EVI', 'NDWI', 'NDBI', 'LST']:
-            map_id = landsat.select(band).getMapId({
-                'min': -0.2 if band != 'LST' else 290,
-                'max': 0.8 if band != 'LST' else 310,
-                'palette': ['blue', 'yellow', 'green'] if band in ['NDVI', 'EVI'] else ['red', 'yellow', 'blue']
-            })
-            if 'tile_fetcher' not in map_id:
-                logger.error(f"Failed to get map ID for {band}")
-                raise Exception(f"Failed to get map ID for {band}")
-            map_data[band] = map_id['tile_fetcher'].url_format
-        map_id = albedo.getMapId({'min': 0, 'max': 0.3, 'palette': ['black', 'white']})
-        map_data['albedo'] = map_id['tile_fetcher'].url_format if 'tile_fetcher' in map_id else ''
-        map_id = dem.select('elevation').getMapId({'min': 0, 'max': 1000, 'palette': ['green', 'brown']})
-        map_data['elevation'] = map_id['tile_fetcher'].url_format if 'tile_fetcher' in map_id else ''
-        map_id = water.getMapId({'min': 0, 'max': 100, 'palette': ['white', 'blue']})
-        map_data['water'] = map_id['tile_fetcher'].url_format if 'tile_fetcher' in map_id else ''
-        map_id = no2.getMapId({'min': 0, 'max': 0.0001, 'palette': ['green', 'yellow', 'red']})
-        map_data['no2'] = map_id['tile_fetcher'].url_format if 'tile_fetcher' in map_id else ''
+        executor = ThreadPoolExecutor(max_workers=len(layers) + 1)
+        try:
+            futures = {
+                executor.submit(get_tile_url, image, vis_params, name, required): name
+                for name, (image, vis_params, required) in layers.items()
+            }
+            futures[executor.submit(check_image_counts, bounds_date_filter, 'NO2')] = None
+            for done, future in enumerate(iter_completed(futures, cancel_event), 1):
+                result = future.result()
+                if futures[future] is not None:
+                    map_data[futures[future]] = result
+                report(20 + done * 7)
+        finally:
+            executor.shutdown(wait=False)
+        # Don't pin a layer that fell back to '' for the cache lifetime
+        if all(map_data.values()):
+            set_cached_map_data(cache_key, map_data)
+        else:
+            logger.info("Map data incomplete, not caching")
         
         logger.info("Map data generated successfully")
         return map_data
+    except AnalysisCancelled:
+        logger.info("Process satellite data cancelled")
+        raise
     except Exception as e:
         logger.error(f"Process satellite data error: {str(e)}")
         raise
\ No newline at end of file